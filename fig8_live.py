@@ -44,10 +44,10 @@ def generateIdealFigureEightPositions(xsize, alinesPerX, rpt=1, flyback=20):
 
         b1 = np.concatenate(
             [np.zeros(flyback), np.ones(alinesPerX), np.zeros(flyback), np.zeros(alinesPerX)]).astype(
-            np.bool)
+            bool)
         b2 = np.concatenate(
             [np.zeros(flyback), np.zeros(alinesPerX), np.zeros(flyback), np.ones(alinesPerX)]).astype(
-            np.bool)
+            bool)
 
         pos = np.empty(int(2 * len(X)), dtype=np.float32)
 
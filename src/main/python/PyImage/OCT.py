@@ -1,6 +1,14 @@
 import numpy as np
 import numba
-from scipy.interpolate import interp1d
+import scipy.fft
+
+try:  # GPU processing is optional, and only used if CuPy can see a CUDA device
+    import cupy
+    import cupyx
+    if cupy.cuda.runtime.getDeviceCount() < 1:
+        cupy = None
+except Exception:  # ImportError, or CUDARuntimeError without a driver
+    cupy = None
 
 
 def generateIdealFigureEightPositions(xdistance, alinesPerX, rpt=1, padB=0, angle=np.pi / 4, flyback=20, flybackAngle=np.pi / 2.58):
@@ -35,27 +43,23 @@ def generateIdealFigureEightPositions(xdistance, alinesPerX, rpt=1, padB=0, angl
 
         D = np.sqrt((B1[0][0] - B1[0][1]) ** 2 + (B1[1][0] - B1[1][1]) ** 2)
 
-        x1 = 1.93 * fbscale * xsize * np.cos(fb1)
-        y1 = fbscale * xsize * np.sin(2 * fb1)
-        x2 = 1.93 * fbscale * xsize * np.cos(fb2)
-        y2 = fbscale * xsize * np.sin(2 * fb2)
+        # Both flyback loops are evaluated together
+        fb = np.concatenate([fb1, fb2])
+        [x1, x2] = np.split(1.93 * fbscale * xsize * np.cos(fb), 2)
+        [y1, y2] = np.split(fbscale * xsize * np.sin(2 * fb), 2)
 
         X = np.concatenate([x1, B1[0], x2, B2[0]])
         Y = np.concatenate([y1, B1[1], y2, B2[1]])
 
         [X, Y] = np.matmul(rotmat, [X, Y])
 
-        b1 = np.concatenate(
-            [np.zeros(flyback+padB), np.ones(alinesPerX-padB), np.zeros(flyback), np.zeros(alinesPerX)]).astype(
-            np.bool)
-        b2 = np.concatenate(
-            [np.zeros(flyback), np.zeros(alinesPerX), np.zeros(flyback+padB), np.ones(alinesPerX-padB)]).astype(
-            np.bool)
-
-        pos = np.empty(int(2 * len(X)), dtype=np.float32)
+        b1 = np.arange(flyback + padB, flyback + alinesPerX, dtype=np.intp)
+        b2 = np.arange(2 * flyback + alinesPerX + padB, 2 * (flyback + alinesPerX), dtype=np.intp)
 
-        pos[0::2] = X
-        pos[1::2] = Y
+        pos = np.empty((len(X), 2), dtype=np.float32)
+        pos[:, 0] = X
+        pos[:, 1] = Y
+        pos = pos.ravel()  # [x1,y1,x2,y2...]
 
         posRpt = np.tile(pos, rpt)
 
@@ -64,26 +68,213 @@ def generateIdealFigureEightPositions(xdistance, alinesPerX, rpt=1, padB=0, angl
         return [posRpt, X, Y, b1, b2, N, D]
 
 
-@numba.jit(forceobj=True)
-def preprocess8(A,N,B,AlinesPerX,apod):
+def linearInterpolationCoefficients(lam, n=2048):
+    """
+    Computes the indices and weights which linearly interpolate a spectrum sampled at lam onto n evenly spaced points
+    :param lam: Strictly increasing or decreasing wavelength of each spectrometer pixel
+    :param n: Number of evenly spaced points to interpolate onto. Default is 2048
+    :return: idx: Index of the left neighbor in lam of each interpolated point
+             w: float32 weight of the right neighbor of each interpolated point
+    """
+    step = np.diff(lam)
+    if np.all(step < 0):
+        # Interpolate the reversed chirp, then map its neighbors and weights back to the original pixel order
+        idx, w = linearInterpolationCoefficients(lam[::-1], n)
+        return len(lam) - 2 - idx, 1 - w
+    if not np.all(step > 0):
+        raise ValueError('Wavelength array must be strictly monotonic')
+    target = np.linspace(np.min(lam), np.max(lam), n)
+    idx = np.clip(np.searchsorted(lam, target) - 1, 0, len(lam) - 2)
+    w = ((target - lam[idx]) / (lam[idx + 1] - lam[idx])).astype(np.float32)
+    return idx, w
+
+
+@numba.njit(cache=True, fastmath=True, boundscheck=False)
+def preprocess8(A, N, B_idx, AlinesPerX, apod):
     """
     Compiled w numba. Reshapes raw figure-8 OCT data into a B scan
     :param A: Raw uint16 OCT spectral data
     :param N: The total number of A-scans in each figure-8
-    :param B: Boolean array of indices size N indicating B-scan
+    :param B_idx: Indices of the A-scans of the B-scan
     :param AlinesPerX: Number of A-scans in the B-scan
+    :param apod: float32 apodization window
+    :return: 2D float32 preprocessed data, [z,n] where z is axial dimension, n is lateral A-scans
+    """
+    flattened = A.ravel()
+    pp = np.empty((AlinesPerX, 2048), dtype=np.float32)  # Transposed on return so each A-scan is contiguous
+    dc = np.zeros(2048)
+    for n in range(AlinesPerX):
+        offset = 2048 * B_idx[n]
+        for z in range(2048):
+            pp[n, z] = flattened[offset + z]
+            dc[z] += pp[n, z]
+    window = (apod * AlinesPerX / dc).astype(np.float32)
+    for n in range(AlinesPerX):
+        for z in range(2048):
+            pp[n, z] *= window[z]
+    return pp.T
+
+
+def reshape8(A, N, B1, B2):
+    """
+    Reshapes raw figure-8 OCT data into its two B-scans without processing
+    :param A: Raw uint16 OCT spectral data
+    :param N: The total number of A-scans in each figure-8
+    :param B1: Indices of the A-scans of the first B-scan
+    :param B2: Indices of the A-scans of the second B-scan
+    :return: 3D uint16 raw data, [z,n,b] where z is axial dimension, n is lateral A-scans, b is B-scan
+    """
+    spectra = A.reshape(N, 2048)
+    return np.stack([spectra[B1].T, spectra[B2].T], axis=2)
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def interpolateColumns(pp, idx, w, out):
+    """
+    Compiled w numba. Linearly interpolates each column of a B-scan in parallel
+    :param pp: 2D preprocessed data from preprocess8, [z,n]
+    :param idx: Interpolation indices from linearInterpolationCoefficients
+    :param w: Interpolation weights from linearInterpolationCoefficients
+    :param out: float32 output array [z,n] of size len(idx) by number of A-scans
+    """
+    M, N = out.shape
+    for n in numba.prange(N):
+        for j in range(M):
+            out[j, n] = pp[idx[j], n] + w[j] * (pp[idx[j] + 1, n] - pp[idx[j], n])
+
+
+@numba.njit(cache=True)
+def fig8Window(A, B_idx, apod):
+    """
+    Compiled w numba. Divides the apodization window by the mean spectrum of a B-scan
+    :param A: Raw uint16 OCT spectral data
+    :param B_idx: Indices of the A-scans of the B-scan
     :param apod: Apodization window
-    :return: 2D Preprocessed data, [z,n] where z is axial dimension, n is lateral A-scans
-    """
-    flattened = A.flatten()
-    pp = np.empty([2048,AlinesPerX],dtype=np.double)
-    i = 0
-    for n in np.arange(N):
-        if B[n]:
-            pp[:, i] = flattened[2048 * n:2048 * n + 2048]
-            i += 1
-    dc = np.mean(pp, axis=1)
-    window = apod / dc
-    for n in np.arange(AlinesPerX):
-        pp[:,n] = pp[:, n] * window
-    return pp
\ No newline at end of file
+    :return: float32 window by which each raw spectrum of the B-scan is multiplied
+    """
+    flattened = A.ravel()
+    n = len(apod)
+    dc = np.zeros(n)
+    for i in B_idx:
+        for z in range(n):
+            dc[z] += flattened[n * i + z]
+    return (apod * len(B_idx) / dc).astype(np.float32)
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def fig8Interpolate(A, B_idx, window, idx, w, out):
+    """
+    Compiled w numba. Windows and interpolates each A-scan of a B-scan directly from the raw data, in parallel
+    :param A: Raw uint16 OCT spectral data
+    :param B_idx: Indices of the A-scans of the B-scan
+    :param window: Window from fig8Window
+    :param idx: Interpolation indices from linearInterpolationCoefficients
+    :param w: Interpolation weights from linearInterpolationCoefficients
+    :param out: float32 output array [z,n] of size len(idx) by len(B_idx). Column-major so each A-scan is contiguous
+    """
+    flattened = A.ravel()
+    n = len(window)
+    for i in numba.prange(len(B_idx)):
+        offset = n * B_idx[i]
+        for z in range(len(idx)):
+            j = idx[z]
+            left = flattened[offset + j] * window[j]
+            right = flattened[offset + j + 1] * window[j + 1]
+            out[z, i] = left + w[z] * (right - left)
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def fig8Magnitude(spectrum, start, stop, scale, out):
+    """
+    Compiled w numba. Crops a B-scan spectrum to the axial ROI and writes its magnitude in display orientation
+    :param spectrum: complex64 B-scan [z,n]
+    :param start: First axial pixel of the ROI
+    :param stop: Axial pixel after the last of the ROI
+    :param scale: Factor by which the magnitude is multiplied
+    :param out: float32 output array [n,z] of size number of A-scans by stop-start
+    """
+    for i in numba.prange(spectrum.shape[1]):
+        for z in range(start, stop):
+            out[i, z - start] = abs(spectrum[z, i]) * scale
+
+
+def fig8Pipeline(A, B_idx, window, idx, w, start, stop, out):
+    """
+    Processes raw figure-8 OCT data into a display B-scan. A-scans are windowed and interpolated in one pass without
+    an intermediate copy of the raw B-scan, transformed with a single batched real FFT, and only the axial ROI is
+    written as magnitude in display orientation.
+    :param A: Raw uint16 OCT spectral data
+    :param B_idx: Indices of the A-scans of the B-scan
+    :param window: Window from fig8Window
+    :param idx: Interpolation indices from linearInterpolationCoefficients
+    :param w: Interpolation weights from linearInterpolationCoefficients
+    :param start: First axial pixel of the ROI
+    :param stop: Axial pixel after the last of the ROI
+    :param out: float32 output array [n,z] of size len(B_idx) by stop-start
+    """
+    interpolated = np.empty([len(idx), len(B_idx)], dtype=np.float32, order='F')
+    fig8Interpolate(A, B_idx, window, idx, w, interpolated)
+    spectrum = scipy.fft.rfft(interpolated, axis=0, workers=-1)
+    fig8Magnitude(spectrum, start, stop, np.float32(1 / len(idx)), out)
+
+
+class CudaPipeline8:
+    """
+    Processes figure-8 B-scans on the GPU with cupy. Each frame is uploaded on one CUDA stream while the previous frame
+    is processed on another, so results are returned one frame late.
+    """
+
+    def __init__(self, shape, idx, w):
+        """
+        :param shape: Shape of the raw uint16 frames
+        :param idx: Interpolation indices from linearInterpolationCoefficients
+        :param w: Interpolation weights from linearInterpolationCoefficients
+        """
+        self._copyStream = cupy.cuda.Stream(non_blocking=True)
+        self._procStream = cupy.cuda.Stream(non_blocking=True)
+        self._pinned = [cupyx.empty_pinned(shape, dtype=np.uint16) for i in range(2)]
+        self._raw = [cupy.empty(shape, dtype=cupy.uint16) for i in range(2)]
+        self._idx = cupy.asarray(idx)
+        self._w = cupy.asarray(w)[:, None]
+        self._slot = 0
+        self._pending = None  # Upload event and parameters of the frame not yet processed
+        self._B_idx = None  # Host arrays of which the device copies below were made
+        self._window = None
+        self._dB_idx = None
+        self._dWindow = None
+
+    def process(self, A, B_idx, window, start, stop):
+        """
+        Uploads a frame, then processes the frame uploaded by the previous call
+        :param A: Raw uint16 OCT spectral data
+        :param B_idx: Indices of the A-scans of the B-scan
+        :param window: Window from fig8Window
+        :param start: First axial pixel of the ROI
+        :param stop: Axial pixel after the last of the ROI
+        :return: float32 magnitude B-scan [n,z] of the previous frame, or None if there is no previous frame
+        """
+        slot = self._slot
+        np.copyto(self._pinned[slot], A)
+        self._raw[slot].set(self._pinned[slot], stream=self._copyStream)
+        uploaded = self._copyStream.record()
+
+        bscan = None
+        if self._pending is not None:
+            event, B_idx_prev, window_prev, start_prev, stop_prev = self._pending
+            self._procStream.wait_event(event)
+            with self._procStream:
+                # B-scan indices and window rarely change, so they are only uploaded when they do
+                if B_idx_prev is not self._B_idx:
+                    self._B_idx, self._dB_idx = B_idx_prev, cupy.asarray(B_idx_prev)
+                if window_prev is not self._window:
+                    self._window, self._dWindow = window_prev, cupy.asarray(window_prev)[:, None]
+                pp = self._raw[1 - slot].reshape(-1, 2048)[self._dB_idx].T.astype(cupy.float32)
+                pp *= self._dWindow
+                interpolated = (1 - self._w) * pp[self._idx, :] + self._w * pp[self._idx + 1, :]
+                spectrum = cupy.fft.rfft(interpolated, axis=0)
+                bscan = (cupy.abs(spectrum[start_prev:stop_prev, :]).T / 2048).get(stream=self._procStream)
+            self._procStream.synchronize()
+
+        self._pending = (uploaded, B_idx, window, start, stop)
+        self._slot = 1 - slot
+        return bscan
@@ -1,10 +1,10 @@
 import os
 import time
 import threading
-from copy import deepcopy
 from queue import Queue, Full
 
 import h5py
+import scipy.fft
 from PyQt5.QtWidgets import QWidget, QGridLayout
 from pyqtgraph.Qt import QtGui
 
@@ -13,6 +13,50 @@ from src.main.python.PyImage import Widgets
 from src.main.python.PyImage.OCT import *
 
 
+class RingBuffer:
+    """
+    Single-producer single-consumer ring of preallocated arrays. The producer copies frames directly into a free slot
+    and the consumer processes them in place, so frames pass between threads without locks, copies or allocation.
+    """
+
+    def __init__(self, length):
+        self._length = length
+        self._slots = []
+        self._head = 0  # Only written by the producer
+        self._tail = 0  # Only written by the consumer
+        self._ready = threading.Event()
+
+    def allocate(self, shape, dtype):
+        self._slots = [np.empty(shape, dtype=dtype) for i in range(self._length)]
+
+    def claim(self):
+        """
+        :return: Next free slot for the producer to fill, or None if the consumer holds all of them
+        """
+        if self._head - self._tail >= self._length:
+            return None
+        return self._slots[self._head % self._length]
+
+    def commit(self):
+        self._head += 1
+        self._ready.set()
+
+    def get(self, timeout=None):
+        """
+        Waits for a filled slot. It is not overwritten until release is called
+        :param timeout: Seconds to wait. Default is to wait indefinitely
+        :return: Oldest filled slot, or None if timed out
+        """
+        while self._head == self._tail:
+            self._ready.clear()
+            if self._head == self._tail and not self._ready.wait(timeout):
+                return None
+        return self._slots[self._tail % self._length]
+
+    def release(self):
+        self._tail += 1
+
+
 class FigureEight:
 
     def __init__(self, parent):
@@ -49,6 +93,7 @@ class FigureEight:
         self._config = "ProbeLKM10-LV"  # TODO un-hardcode default
         self._apodWindow = None
         self._displayAxis = 0
+        self._windowCache = None  # apod/dc for the displayed B-scan
 
         # SpectralRadar handles
         self._device = None
@@ -59,12 +104,14 @@ class FigureEight:
         self._acquisitionType = None
         self._triggerTimeout = None
         self._lam = None
+        self._interpIdx = None
+        self._interpWeights = None
 
         # OS
         self._threads = []
         self.active = False
         self._RawQueue = Queue()
-        self._ProcQueue = Queue(maxsize=1)
+        self._ProcRing = RingBuffer(2)
 
         # Qt
         self._widgets = []
@@ -166,6 +213,8 @@ class FigureEight:
             for y in np.arange(2048):
                 self._lam[y] = PySpectralRadar.getWavelengthAtPixel(self._device, y)
             np.save('lam', self._lam)
+        # The chirp is fixed, so interpolation coefficients are computed once here rather than for every frame
+        self._interpIdx, self._interpWeights = linearInterpolationCoefficients(self._lam)
         self.progress.setProgress(10)
         self.progress.setText('Done!')
         print('Telesto initialized successfully.')
@@ -230,14 +279,16 @@ class FigureEight:
     def getRawQueue(self):
         return self._RawQueue
 
-    def getProcessingQueue(self):
-        return self._ProcQueue
+    def getProcessingRing(self):
+        return self._ProcRing
 
     def setDisplayAxis(self, axis):
         self._displayAxis = axis
+        self._windowCache = None
 
     def setApodWindow(self, window):
-        self._apodWindow = window
+        self._apodWindow = window.astype(np.float32)  # Keeps B-scan processing in single precision
+        self._windowCache = None
 
     def getApodWindow(self):
         return self._apodWindow
@@ -278,7 +329,10 @@ class FigureEight:
             widget.enabled(False)
 
         acq = threading.Thread(target=self.acquire)
-        exp = threading.Thread(target=self.export_npy)
+        if self._fileType == '.hdf':
+            exp = threading.Thread(target=self.export_hdf)
+        else:
+            exp = threading.Thread(target=self.export_npy)
         self._threads.append(acq)
         self._threads.append(exp)
 
@@ -286,67 +340,85 @@ class FigureEight:
             thread.start()
 
     @numba.jit(forceobj=True)
-    def process8(self, A, B1, ROI, B2=np.zeros(1)):
+    def process8(self, A, B1, ROI, B2=None):
 
+        # The spectra are real, so the inverse FFT is the conjugate of the normalized half-spectrum rfft
         Nx = self._scanPatternAlinesPerCross
         N = self.scanPatternN
-        interpIndices = np.linspace(min(self._lam), max(self._lam), 2048)
+        idx, w = self._interpIdx, self._interpWeights
+        interpolated = np.empty([2048, Nx], dtype=np.float32, order='F')
 
-        if B2.any() != 0:
+        if B2 is not None:
 
             processed = np.empty([1024, Nx, 2], dtype=np.complex64)
             Bs = [B1, B2]
 
             for b, B in enumerate(Bs):
 
-                interpolated = np.empty([2048, Nx])
                 preprocessed = preprocess8(A, N, B, Nx, self.getApodWindow())
-
-                for n in np.arange(Nx):
-                    k = interp1d(self._lam, preprocessed[:, n])
-                    interpolated[:, n] = k(interpIndices)
-                    processed[:, n, b] = np.fft.ifft(interpolated[:, n])[0:1024].astype(np.complex64)
+                interpolateColumns(preprocessed, idx, w, interpolated)
+                processed[:, :, b] = np.conj(scipy.fft.rfft(interpolated, axis=0, norm='forward', workers=-1)[0:1024, :])
 
         else:
 
-            processed = np.zeros([1024, Nx], dtype=np.complex64)
-
-            interpolated = np.empty([2048, Nx])
             preprocessed = preprocess8(A, N, B1, Nx, self.getApodWindow())
-
-            for n in np.arange(Nx):
-                k = interp1d(self._lam, preprocessed[:, n])
-                interpolated[:, n] = k(interpIndices)
-                processed[:, n] = np.fft.ifft(interpolated[:, n])[0:1024].astype(np.complex64)
+            interpolateColumns(preprocessed, idx, w, interpolated)
+            processed = np.conj(scipy.fft.rfft(interpolated, axis=0, norm='forward', workers=-1)[0:1024, :])
 
         return processed[ROI[0]:ROI[1], :]
 
     def display(self):
 
         running = True
-        processingQueue = self.getProcessingQueue()
+        processingRing = self.getProcessingRing()
         Bs = [self.scanPatternB1, self.scanPatternB2]
+        idx, w = self._interpIdx, self._interpWeights
+        gpu = None
+        out = None
+        counter = 0
 
-        while running and self.active:
-            B = Bs[self._displayAxis]
-            try:
-                raw = processingQueue.get()
-                spec = raw.flatten()[0:2048]  # First spectrum of the B-scan only is plotted
-
-                bscan = self.process8(raw, B, ROI=self._roi_z)
+        # The mean spectrum changes slowly, so the window is only recomputed every few frames
+        windowInterval = 16
+        windowAxis = None
+        self._windowCache = None
 
-                self.plotSpectrum.plot1D(spec)
-                self.plotBScan.update(20 * np.log10(np.abs(np.transpose(bscan))))
-                QtGui.QGuiApplication.processEvents()
+        while running and self.active:
+            # Read once per frame, as the GUI thread can change the axis or clear the cache at any time
+            axis = self._displayAxis
+            B_idx = Bs[axis]
+            start, stop = self._roi_z
+            raw = processingRing.get(timeout=1)
+            if raw is None:
+                continue
+            spec = raw.reshape(-1)[0:2048].copy()  # First spectrum of the B-scan only is plotted
+
+            window = self._windowCache
+            if window is None or axis != windowAxis or counter % windowInterval == 0:
+                window = self._windowCache = fig8Window(raw, B_idx, self.getApodWindow())
+                windowAxis = axis
+            if cupy is not None:
+                if gpu is None:
+                    gpu = CudaPipeline8(raw.shape, idx, w)
+                bscan = gpu.process(raw, B_idx, window, start, stop)
+            else:
+                # Output buffer is reused until the ROI or displayed B-scan size changes
+                if out is None or out.shape != (len(B_idx), stop - start):
+                    out = np.empty([len(B_idx), stop - start], dtype=np.float32)
+                fig8Pipeline(raw, B_idx, window, idx, w, start, stop, out)
+                bscan = out
+            counter += 1
+            processingRing.release()  # Nothing below reads the slot, so the producer can refill it
 
-            except Full:
-                pass
+            self.plotSpectrum.plot1D(spec)
+            if bscan is not None:  # The GPU pipeline has no output for the first frame
+                self.plotBScan.update(20 * np.log10(bscan))
+            QtGui.QGuiApplication.processEvents()
 
     def scan(self):
 
         self.progress.setText('Scanning...')
         running = True
-        processingQueue = self.getProcessingQueue()
+        processingRing = self.getProcessingRing()
         counter = 0
 
         # Set number of frames to process based on predicted speed
@@ -356,31 +428,23 @@ class FigureEight:
 
         self.getRawData(rawDataHandle)
 
+        dim = PySpectralRadar.getRawDataShape(rawDataHandle)
+        processingRing.allocate(dim, np.uint16)
+
         self.startMeasurement()
 
         while running and self.active:
 
             self.getRawData(rawDataHandle)
 
-            dim = PySpectralRadar.getRawDataShape(rawDataHandle)
-
-            temp = np.empty(dim, dtype=np.uint16)
-
-            PySpectralRadar.copyRawDataContent(rawDataHandle, temp)
-
-            if np.size(temp) > 0:
-
-                if counter % interval == 0:
-
-                    new = deepcopy(temp)
+            if counter % interval == 0:
 
-                    try:
+                temp = processingRing.claim()
 
-                        processingQueue.put(new)
+                if temp is not None:  # Otherwise display is behind and the frame is dropped
 
-                    except Full:
-
-                        pass
+                    PySpectralRadar.copyRawDataContent(rawDataHandle, temp)
+                    processingRing.commit()
 
             counter += 1
 
@@ -394,23 +458,21 @@ class FigureEight:
 
         self.getRawData(rawDataHandle)
 
+        dim = PySpectralRadar.getRawDataShape(rawDataHandle)  # Fixed by the scan pattern
+
         self.startMeasurement()
 
         for i in np.arange(self._scanPatternTotalRepeats):
 
             self.getRawData(rawDataHandle)
 
-            dim = PySpectralRadar.getRawDataShape(rawDataHandle)
-
             temp = np.empty(dim, dtype=np.uint16)
 
             PySpectralRadar.copyRawDataContent(rawDataHandle, temp)
 
-            new = deepcopy(temp)
-
             try:
 
-                rawQueue.put(new)
+                rawQueue.put(temp)
 
             except Full:
 
@@ -422,9 +484,30 @@ class FigureEight:
 
         print('Acquisition complete')
 
-    def export_hdf(self):  # TODO fix this
+    def export_hdf(self):
 
-        pass
+        self.progress.setText('Exporting...')
+
+        q = self.getRawQueue()
+        try:
+            os.mkdir(self._fileExperimentDirectory)
+        except FileExistsError:
+            pass
+        rawshape = [2048, self._scanPatternAlinesPerCross, 2, self._scanPatternTotalRepeats]
+
+        with h5py.File(self.getFilepath() + '.hdf', 'w') as root:  # TODO: implement max file size
+            # Each frame is one chunk, compressed as it is written
+            raw = root.create_dataset('raw', rawshape, dtype=np.uint16, chunks=tuple(rawshape[0:3]) + (1,),
+                                      compression='lzf', shuffle=True)
+
+            for i in np.arange(self._scanPatternTotalRepeats):
+                temp = q.get()
+
+                raw[:, :, :, i] = reshape8(temp, self.scanPatternN, self.scanPatternB1, self.scanPatternB2)
+
+        self.progress.setText('Export complete!')
+        print('Saving .hdf complete')
+        self._endAcquisition()
 
     def export_npy(self):
 
@@ -449,6 +532,9 @@ class FigureEight:
         self.progress.setText('Export complete!')
         np.save(root, out)
         print('Saving .npy complete')
+        self._endAcquisition()
+
+    def _endAcquisition(self):
         # This is just the abort method w/o call to stop measurement
         self.progress.setText('Stopped')
         self.progress.setProgress(0)
@@ -458,7 +544,7 @@ class FigureEight:
                 thread._is_running = False
             self._threads = []
             self._RawQueue = Queue()
-            self._ProcQueue = Queue()
+            self._ProcRing = RingBuffer(2)
             for widget in self._widgets:
                 widget.enabled(True)
 
@@ -472,7 +558,7 @@ class FigureEight:
                 thread._is_running = False
             self._threads = []
             self._RawQueue = Queue()
-            self._ProcQueue = Queue()
+            self._ProcRing = RingBuffer(2)
             self.stopMeasurement()
             for widget in self._widgets:
                 widget.enabled(True)
@@ -531,7 +617,9 @@ class FigureEight:
                                                                 flybackAngle=flybackAngle)
 
     def displayPattern(self):
-        self.plotPattern.plotFigEight(self.scanPatternX[np.invert(self.scanPatternB1 + self.scanPatternB2)],
-                                      self.scanPatternY[np.invert(self.scanPatternB1 + self.scanPatternB2)],
-                                      self.scanPatternX[self.scanPatternB1 + self.scanPatternB2],
-                                      self.scanPatternY[self.scanPatternB1 + self.scanPatternB2])
\ No newline at end of file
+        B = np.concatenate([self.scanPatternB1, self.scanPatternB2])
+        flyback = np.delete(np.arange(self.scanPatternN), B)
+        self.plotPattern.plotFigEight(self.scanPatternX[flyback],
+                                      self.scanPatternY[flyback],
+                                      self.scanPatternX[B],
+                                      self.scanPatternY[B])
\ No newline at end of file